@@ -1,13 +1,62 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import os
 
-DATABASE_URL = "sqlite:///./todos.db"
+from sqlalchemy import event, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 
-engine = create_engine(
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./todos.db")
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", DATABASE_URL)
+
+
+def driver_connect_args(url):
+    if make_url(url).drivername == "postgresql+asyncpg":
+        # Keep server-side prepared statements around for the hot single-row endpoints.
+        return {"prepared_statement_cache_size": 512, "statement_cache_size": 512}
+    return {}
+
+
+engine = create_async_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False},
+    pool_size=20,
+    max_overflow=40,
+    pool_timeout=10,
+    pool_recycle=1800,
+    pool_pre_ping=True,
+    query_cache_size=1200,
+    connect_args=driver_connect_args(DATABASE_URL),
+)
+
+# Read-only endpoints get their own pool (optionally on a replica) so readers are not
+# starved by write bursts.
+read_engine = create_async_engine(
+    READ_DATABASE_URL,
+    pool_size=30,
+    max_overflow=10,
+    pool_timeout=10,
+    pool_recycle=1800,
+    pool_pre_ping=True,
+    query_cache_size=1200,
+    connect_args=driver_connect_args(READ_DATABASE_URL),
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def enable_sqlite_wal(dbapi_connection, connection_record):
+    # WAL lets writers commit while a streaming export still holds its read cursor open.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+for sqlite_engine in (engine, read_engine):
+    if sqlite_engine.dialect.name == "sqlite":
+        event.listen(sqlite_engine.sync_engine, "connect", enable_sqlite_wal)
+
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+# AUTOCOMMIT skips the implicit BEGIN/COMMIT around plain reads. Streaming exports keep the
+# engine's default isolation, since server-side cursors (asyncpg) need an open transaction.
+ReadSessionLocal = async_sessionmaker(
+    bind=read_engine.execution_options(isolation_level="AUTOCOMMIT"), autoflush=False, expire_on_commit=False
+)
+StreamSessionLocal = async_sessionmaker(bind=read_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
@@ -1,16 +1,26 @@
-from typing import List, Optional
+from typing import List, Optional, get_args
 from datetime import datetime, timezone
 import os
 import io
 import csv
+import asyncio
+import hashlib
+import logging
+from contextvars import ContextVar
+from secrets import compare_digest
 
-from fastapi import FastAPI, Depends, HTTPException, Query, Path, status, Request, Header
+import orjson
+from cachetools import TTLCache
+
+from fastapi import FastAPI, Depends, HTTPException, Query, Path, status, Request, Response, Security
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
+from fastapi.security import APIKeyHeader
+from fastapi.middleware.gzip import GZipMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, select, insert, update, func, event, cast, String, DateTime
 
-from .db import Base, engine, SessionLocal
+from .db import Base, engine, read_engine, SessionLocal, ReadSessionLocal, StreamSessionLocal
 from .models import TodoModel
 from .schemas import (
     TodoCreate,
@@ -21,28 +31,112 @@ from .schemas import (
     TodoStats,
     HealthOut,
     Priority,
+    TodoStatus,
     SortBy,
     OrderBy,
     ExportFormat,
 )
 
-API_KEY = os.getenv("TODO_API_KEY", "name_here")
+API_KEY = os.getenv("TODO_API_KEY", "name_here").encode()
+api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+P_HIGH, P_MEDIUM, P_LOW = int(Priority.HIGH), int(Priority.MEDIUM), int(Priority.LOW)
+VALID_STATUSES = frozenset(get_args(TodoStatus))
+
+EXPORT_CHUNK_SIZE = 500
+EXPORT_FIELDS = ["todo_id", "todo_name", "todo_description", "priority", "status", "due_date", "is_deleted", "created_at", "updated_at"]
+# Endpoints that return plain rows select these columns to skip ORM object hydration.
+TODO_COLUMNS = [getattr(TodoModel, name) for name in EXPORT_FIELDS]
+
+
+def iso_text(column):
+    # Render a timestamp as ISO 8601 text in SQL so CSV export skips per-row isoformat().
+    if read_engine.dialect.name == "postgresql":
+        return func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS.USTZH:TZM')
+    if read_engine.dialect.name == "sqlite":
+        return func.replace(column, " ", "T")
+    return cast(column, String)
+
+
+CSV_COLUMNS = [
+    iso_text(column).label(column.key) if isinstance(column.type, DateTime) else column
+    for column in TODO_COLUMNS
+]
+
+SORT_ORDERINGS = {
+    (name, order): getattr(getattr(TodoModel, name), order)()
+    for name in get_args(SortBy)
+    for order in get_args(OrderBy)
+}
+
+# Stats are keyed on include_deleted and invalidated by every endpoint that changes priority
+# or is_deleted. The generation counter keeps a miss that raced with a write from caching
+# the pre-write counts.
+stats_cache = TTLCache(maxsize=8, ttl=5)
+stats_lock = asyncio.Lock()
+stats_generation = 0
+
+
+def invalidate_stats():
+    global stats_generation
+    stats_generation += 1
+    stats_cache.clear()
 
 
 api = FastAPI()
-Base.metadata.create_all(bind=engine)
+api.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+logger = logging.getLogger(__name__)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+if os.getenv("DEV_PROFILE"):
+    # Dev-only: count SQL statements per request so N+1 patterns show up before they ship.
+    QUERY_COUNT_WARN = int(os.getenv("DEV_PROFILE_QUERY_WARN", "10"))
+    query_counter: ContextVar[Optional[list]] = ContextVar("query_counter", default=None)
+
+    def count_queries(conn, cursor, statement, parameters, context, executemany):
+        counter = query_counter.get()
+        if counter is not None:
+            counter[0] += 1
+
+    for counted_engine in (engine, read_engine):
+        event.listen(counted_engine.sync_engine, "before_cursor_execute", count_queries)
+
+    @api.middleware("http")
+    async def query_count_header(request: Request, call_next):
+        counter = [0]
+        token = query_counter.set(counter)
+        try:
+            response = await call_next(request)
+        finally:
+            query_counter.reset(token)
+        # Headers go out before a streamed body runs, so X-Query-Count only covers queries issued
+        # up to that point; the warning below is checked after the body, against the full count.
+        response.headers["X-Query-Count"] = str(counter[0])
+        body_iterator = response.body_iterator
+
+        async def counted_body():
+            async for chunk in body_iterator:
+                yield chunk
+            if counter[0] > QUERY_COUNT_WARN:
+                logger.warning("%s %s issued %d queries", request.method, request.url.path, counter[0])
+
+        response.body_iterator = counted_body()
+        return response
+
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def require_api_key(x_api_key: str = Header(default="", alias="X-API-Key")):
-    if x_api_key != API_KEY:
+async def get_db_ro():
+    async with ReadSessionLocal() as db:
+        yield db
+
+
+async def require_api_key(x_api_key: Optional[str] = Security(api_key_header)):
+    if not x_api_key or not compare_digest(x_api_key.encode(), API_KEY):
         raise HTTPException(status_code=401, detail="Invalid or missing API key")
 
 
@@ -62,45 +156,44 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     )
 
 
-def get_or_404(db: Session, todo_id: int, include_deleted: bool = False) -> TodoModel:
-    q = db.query(TodoModel).filter(TodoModel.todo_id == todo_id)
-    if not include_deleted:
-        q = q.filter(TodoModel.is_deleted == False)
-    todo = q.first()
-    if not todo:
+async def get_or_404(db: AsyncSession, todo_id: int, include_deleted: bool = False) -> TodoModel:
+    todo = await db.get(TodoModel, todo_id)
+    if not todo or (todo.is_deleted and not include_deleted):
         raise HTTPException(status_code=404, detail="Todo not found")
     return todo
 
 
 @api.on_event("startup")
-def seed_data():
-    db = SessionLocal()
-    try:
-        exists = db.query(TodoModel).filter(TodoModel.is_deleted == False).first()
+async def seed_data():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with SessionLocal() as db:
+        exists = (await db.execute(select(TodoModel).where(TodoModel.is_deleted == False).limit(1))).scalars().first()
         if not exists:
             now = datetime.now(timezone.utc)
-            db.add_all(
-                [
-                    TodoModel(todo_name="Sports", todo_description="Go to the Gym", priority=int(Priority.MEDIUM), status="IN_PROGRESS", due_date=None),
-                    TodoModel(todo_name="Clean house", todo_description="Cleaning the house thoroughly", priority=int(Priority.HIGH), status="NEW", due_date=None),
-                    TodoModel(todo_name="Read", todo_description="Read chapter 5 of the book", priority=int(Priority.LOW), status="DONE", due_date=None),
-                    TodoModel(todo_name="Work", todo_description="Complete project documentation", priority=int(Priority.MEDIUM), status="NEW", due_date=now),
-                    TodoModel(todo_name="Study", todo_description="Prepare for upcoming exam", priority=int(Priority.LOW), status="NEW", due_date=None),
-                ]
+            await db.execute(
+                insert(TodoModel).values(
+                    [
+                        {"todo_name": "Sports", "todo_description": "Go to the Gym", "priority": P_MEDIUM, "status": "IN_PROGRESS", "due_date": None},
+                        {"todo_name": "Clean house", "todo_description": "Cleaning the house thoroughly", "priority": P_HIGH, "status": "NEW", "due_date": None},
+                        {"todo_name": "Read", "todo_description": "Read chapter 5 of the book", "priority": P_LOW, "status": "DONE", "due_date": None},
+                        {"todo_name": "Work", "todo_description": "Complete project documentation", "priority": P_MEDIUM, "status": "NEW", "due_date": now},
+                        {"todo_name": "Study", "todo_description": "Prepare for upcoming exam", "priority": P_LOW, "status": "NEW", "due_date": None},
+                    ]
+                )
             )
-            db.commit()
-    finally:
-        db.close()
+            await db.commit()
 
 
 @api.get("/health", response_model=HealthOut, tags=["System"])
-def health():
+async def health():
     return {"status": "ok"}
 
 
 @api.get("/todos", response_model=List[TodoOut], tags=["Todos"])
-def list_todos(
-    db: Session = Depends(get_db),
+async def list_todos(
+    db: AsyncSession = Depends(get_db_ro),
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
     priority: Optional[Priority] = Query(None),
@@ -111,194 +204,227 @@ def list_todos(
     order: OrderBy = Query("asc"),
     include_deleted: bool = Query(False),
 ):
-    query = db.query(TodoModel)
+    query = select(*TODO_COLUMNS)
 
     if not include_deleted:
-        query = query.filter(TodoModel.is_deleted == False)
+        query = query.where(TodoModel.is_deleted == False)
 
     if priority is not None:
-        query = query.filter(TodoModel.priority == int(priority))
+        query = query.where(TodoModel.priority == priority)
 
     if status_filter is not None:
-        query = query.filter(TodoModel.status == status_filter)
+        if status_filter not in VALID_STATUSES:
+            return []
+        query = query.where(TodoModel.status == status_filter)
 
     if q:
-        query = query.filter(
+        # Wildcards in q are escaped so the search stays a literal substring match;
+        # on Postgres the ix_todos_*_trgm GIN indexes serve this ILIKE directly.
+        pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.where(
             or_(
-                TodoModel.todo_name.ilike(f"%{q}%"),
-                TodoModel.todo_description.ilike(f"%{q}%"),
+                TodoModel.todo_name.ilike(pattern, escape="\\"),
+                TodoModel.todo_description.ilike(pattern, escape="\\"),
             )
         )
 
     if overdue:
         now = datetime.now(timezone.utc)
-        query = query.filter(TodoModel.due_date.isnot(None)).filter(TodoModel.due_date < now)
+        query = query.where(TodoModel.due_date.isnot(None), TodoModel.due_date < now)
 
-    sort_col = getattr(TodoModel, sort_by)
-    query = query.order_by(sort_col.desc() if order == "desc" else sort_col.asc())
+    query = query.order_by(SORT_ORDERINGS[sort_by, order])
 
-    return query.offset(offset).limit(limit).all()
+    return (await db.execute(query.offset(offset).limit(limit))).all()
 
 
 @api.get("/todos/export", tags=["Todos"])
-def export_todos(
-    db: Session = Depends(get_db),
+async def export_todos(
     format: ExportFormat = Query("json"),
     include_deleted: bool = Query(False),
 ):
-    query = db.query(TodoModel)
+    stmt = select(*(CSV_COLUMNS if format == "csv" else TODO_COLUMNS))
     if not include_deleted:
-        query = query.filter(TodoModel.is_deleted == False)
+        stmt = stmt.where(TodoModel.is_deleted == False)
+    stmt = stmt.order_by(TodoModel.todo_id.asc()).execution_options(stream_results=True, yield_per=EXPORT_CHUNK_SIZE)
 
-    todos = query.order_by(TodoModel.todo_id.asc()).all()
+    # The generator owns its session so rows keep streaming after the handler has returned.
+    async def partitions():
+        async with StreamSessionLocal() as db:
+            async for part in (await db.stream(stmt)).partitions():
+                yield part
 
     if format == "json":
-        return [
-            {
-                "todo_id": t.todo_id,
-                "todo_name": t.todo_name,
-                "todo_description": t.todo_description,
-                "priority": t.priority,
-                "status": t.status,
-                "due_date": t.due_date,
-                "is_deleted": t.is_deleted,
-                "created_at": t.created_at,
-                "updated_at": t.updated_at,
-            }
-            for t in todos
-        ]
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["todo_id", "todo_name", "todo_description", "priority", "status", "due_date", "is_deleted", "created_at", "updated_at"])
-    for t in todos:
-        writer.writerow(
-            [
-                t.todo_id,
-                t.todo_name,
-                t.todo_description,
-                t.priority,
-                t.status,
-                t.due_date.isoformat() if t.due_date else "",
-                t.is_deleted,
-                t.created_at.isoformat() if t.created_at else "",
-                t.updated_at.isoformat() if t.updated_at else "",
-            ]
-        )
-    output.seek(0)
-    return StreamingResponse(output, media_type="text/csv", headers={"Content-Disposition": "attachment; filename=todos.csv"})
+        async def gen_json():
+            sep = b"["
+            async for part in partitions():
+                yield sep + b",".join(orjson.dumps(dict(zip(EXPORT_FIELDS, t))) for t in part)
+                sep = b","
+            yield b"[]" if sep == b"[" else b"]"
+
+        return StreamingResponse(gen_json(), media_type="application/json")
+
+    async def gen_csv():
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(EXPORT_FIELDS)
+        yield output.getvalue()
+        async for part in partitions():
+            output.seek(0)
+            output.truncate(0)
+            writer.writerows(part)
+            yield output.getvalue()
+
+    return StreamingResponse(gen_csv(), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=todos.csv"})
 
 
 @api.get("/todos/stats", response_model=TodoStats, tags=["Todos"])
-def todos_stats(db: Session = Depends(get_db), include_deleted: bool = Query(False)):
-    base = db.query(TodoModel)
-    if not include_deleted:
-        base = base.filter(TodoModel.is_deleted == False)
+async def todos_stats(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db_ro),
+    include_deleted: bool = Query(False),
+):
+    async with stats_lock:
+        cached = stats_cache.get(include_deleted)
+        if cached is None:
+            generation = stats_generation
+            stmt = select(TodoModel.priority, func.count()).group_by(TodoModel.priority)
+            if not include_deleted:
+                stmt = stmt.where(TodoModel.is_deleted == False)
+
+            counts = {p: c for p, c in (await db.execute(stmt)).all()}
+            stats = {
+                "total": sum(counts.values()),
+                "high": counts.get(P_HIGH, 0),
+                "medium": counts.get(P_MEDIUM, 0),
+                "low": counts.get(P_LOW, 0),
+            }
+            etag = f'"{hashlib.blake2b(orjson.dumps(stats), digest_size=8).hexdigest()}"'
+            cached = (stats, etag)
+            if generation == stats_generation:
+                stats_cache[include_deleted] = cached
 
-    total = base.count()
-    high = base.filter(TodoModel.priority == int(Priority.HIGH)).count()
-    medium = base.filter(TodoModel.priority == int(Priority.MEDIUM)).count()
-    low = base.filter(TodoModel.priority == int(Priority.LOW)).count()
+    stats, etag = cached
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
 
-    return {"total": total, "high": high, "medium": medium, "low": low}
+    response.headers["ETag"] = etag
+    return stats
 
 
 @api.get("/todos/{todo_id}", response_model=TodoOut, tags=["Todos"])
-def get_todo(
+async def get_todo(
     todo_id: int = Path(..., ge=1),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db_ro),
 ):
-    return get_or_404(db, todo_id)
+    return await get_or_404(db, todo_id)
 
 
 @api.post("/todos", response_model=TodoOut, status_code=status.HTTP_201_CREATED, tags=["Todos"], dependencies=[Depends(require_api_key)])
-def create_todo(todo: TodoCreate, db: Session = Depends(get_db)):
+async def create_todo(todo: TodoCreate, db: AsyncSession = Depends(get_db)):
     new_todo = TodoModel(
         todo_name=todo.todo_name,
         todo_description=todo.todo_description,
-        priority=int(todo.priority),
+        priority=todo.priority,
         status=todo.status,
         due_date=todo.due_date,
     )
     db.add(new_todo)
-    db.commit()
-    db.refresh(new_todo)
+    await db.commit()
+    invalidate_stats()
+    await db.refresh(new_todo)
     return new_todo
 
 
 @api.put("/todos/{todo_id}", response_model=TodoOut, tags=["Todos"], dependencies=[Depends(require_api_key)])
-def replace_todo(
+async def replace_todo(
     todo_id: int = Path(..., ge=1),
     payload: TodoReplace = ...,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    todo = get_or_404(db, todo_id)
+    todo = await get_or_404(db, todo_id)
     todo.todo_name = payload.todo_name
     todo.todo_description = payload.todo_description
-    todo.priority = int(payload.priority)
+    todo.priority = payload.priority
     todo.status = payload.status
     todo.due_date = payload.due_date
-    db.commit()
-    db.refresh(todo)
+    await db.commit()
+    invalidate_stats()
+    await db.refresh(todo)
     return todo
 
 
 @api.patch("/todos/{todo_id}", response_model=TodoOut, tags=["Todos"], dependencies=[Depends(require_api_key)])
-def update_todo(
+async def update_todo(
     todo_id: int = Path(..., ge=1),
     payload: TodoUpdate = ...,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    todo = get_or_404(db, todo_id)
-    data = payload.model_dump(exclude_unset=True)
-
-    if "todo_name" in data:
-        todo.todo_name = data["todo_name"]
-    if "todo_description" in data:
-        todo.todo_description = data["todo_description"]
-    if "priority" in data:
-        todo.priority = int(data["priority"])
-    if "status" in data:
-        todo.status = data["status"]
-    if "due_date" in data:
-        todo.due_date = data["due_date"]
-
-    db.commit()
-    db.refresh(todo)
+    changes = {field: getattr(payload, field) for field in payload.model_fields_set}
+
+    if not changes:
+        return await get_or_404(db, todo_id)
+
+    # A single UPDATE ... RETURNING both applies the patch and reads the row back.
+    stmt = (
+        update(TodoModel)
+        .where(TodoModel.todo_id == todo_id, TodoModel.is_deleted == False)
+        .values(**changes)
+        .returning(*TODO_COLUMNS)
+    )
+    todo = (await db.execute(stmt)).first()
+    if not todo:
+        raise HTTPException(status_code=404, detail="Todo not found")
+
+    await db.commit()
+    invalidate_stats()
     return todo
 
 
 @api.patch("/todos/{todo_id}/status", response_model=TodoOut, tags=["Todos"], dependencies=[Depends(require_api_key)])
-def update_todo_status(
+async def update_todo_status(
     todo_id: int = Path(..., ge=1),
     payload: TodoStatusUpdate = ...,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    todo = get_or_404(db, todo_id)
+    todo = await get_or_404(db, todo_id)
     todo.status = payload.status
-    db.commit()
-    db.refresh(todo)
+    await db.commit()
+    await db.refresh(todo)
     return todo
 
 
 @api.post("/todos/{todo_id}/restore", response_model=TodoOut, tags=["Todos"], dependencies=[Depends(require_api_key)])
-def restore_todo(
+async def restore_todo(
     todo_id: int = Path(..., ge=1),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    todo = get_or_404(db, todo_id, include_deleted=True)
-    todo.is_deleted = False
-    db.commit()
-    db.refresh(todo)
+    stmt = (
+        update(TodoModel)
+        .where(TodoModel.todo_id == todo_id, TodoModel.is_deleted == True)
+        .values(is_deleted=False)
+        .returning(*TODO_COLUMNS)
+    )
+    todo = (await db.execute(stmt)).first()
+    if not todo:
+        # Nothing to restore: an already-active todo is returned unchanged, a missing one is a 404.
+        return await get_or_404(db, todo_id, include_deleted=True)
+
+    await db.commit()
+    invalidate_stats()
     return todo
 
 
 @api.delete("/todos/{todo_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Todos"], dependencies=[Depends(require_api_key)])
-def delete_todo(
+async def delete_todo(
     todo_id: int = Path(..., ge=1),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    todo = get_or_404(db, todo_id)
-    todo.is_deleted = True
-    db.commit()
-    return
+    stmt = update(TodoModel).where(TodoModel.todo_id == todo_id, TodoModel.is_deleted == False).values(is_deleted=True)
+    result = await db.execute(stmt)
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Todo not found")
+
+    await db.commit()
+    invalidate_stats()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
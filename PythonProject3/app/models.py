@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, func
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Index, DDL, event, func
 from .db import Base
 
 
@@ -16,3 +16,20 @@ class TodoModel(Base):
     is_deleted = Column(Boolean, nullable=False, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+    # Partial indexes cover the default (non-deleted) listing path; the trigram
+    # indexes back the ?q= search and are only created on Postgres.
+    __table_args__ = (
+        Index("ix_todos_active_pri", "priority", "todo_id", postgresql_where=is_deleted == False, sqlite_where=is_deleted == False),
+        Index("ix_todos_active_status", "status", postgresql_where=is_deleted == False, sqlite_where=is_deleted == False),
+        Index("ix_todos_active_due", "due_date", postgresql_where=is_deleted == False, sqlite_where=is_deleted == False),
+        Index("ix_todos_name_trgm", "todo_name", postgresql_using="gin", postgresql_ops={"todo_name": "gin_trgm_ops"}).ddl_if(dialect="postgresql"),
+        Index("ix_todos_description_trgm", "todo_description", postgresql_using="gin", postgresql_ops={"todo_description": "gin_trgm_ops"}).ddl_if(dialect="postgresql"),
+    )
+
+
+event.listen(
+    TodoModel.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)